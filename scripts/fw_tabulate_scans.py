@@ -7,13 +7,21 @@
 # Updated:  08/17/2021      
 
 import os
-import pytz
+import csv
 import flywheel
 import argparse
-import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from datetime import date, time, datetime
+from datetime import date, datetime
+
+
+# Flywheel data view columns needed to build each metadata row
+VIEW_COLUMNS = ['file.id', 'subject.label', 'session.label', 'acquisition.label', 'acquisition.timestamp',
+                'file.name', 'file.created', 'file.info.SeriesNumber',
+                'file.info.AcquisitionDateTime', 'file.info.AcquisitionDate', 'file.info.AcquisitionTime']
+
+# Dataframe columns making up each metadata row, in csv column order
+ROW_COLUMNS = ['file.id', 'subject.label', 'session.label', 'acquisition.label', 'file.name',
+               'file.info.SeriesNumber', 'Timestamp', 'Created']
 
 
 def get_project(projectLabel):
@@ -30,135 +38,145 @@ def get_project(projectLabel):
     return project
 
 
-def get_file_data(f, acq):
-    '''Given a Flywheel file object, extract and return fileId, seriesNum, and timestamp.'''
+def to_naive_utc(values):
+    '''Given a series of ISO timestamp strings return them as naive UTC datetimes (NaT where missing or unparseable).'''
 
-    # Get Flywheel fileId to use as unique identifier
-    fileId = f.id
+    return pd.to_datetime(values, errors='coerce', utc=True, format='ISO8601').dt.tz_localize(None)
 
-    # Try to get series number (sometimes field isn't present.) 
-    try:
-        seriesNum = f.info['SeriesNumber']
-    # Set to None if field isn't present
-    except:
-        seriesNum = np.NaN 
-        
-    # Try to get timestamp (sometimes DateTime field isn't present.) 
-    try:
-        timestamp = f.info['AcquisitionDateTime']
-    except KeyError:
-        try: 
-            timestamp = datetime.combine(acq.timestamp.date(), time.fromisoformat(f.info['AcquisitionTime']))
-        except:
-            try:
-                timestamp = f.info['AcquisitionDate']
-            # Set to None if field isn't present
-            except:
-                timestamp = pd.NaT
+
+def normalize_timestamps(df):
+    """ 
+    Add parsed Timestamp and Created columns to a data view dataframe.
     
-    return fileId, seriesNum, timestamp
+    Timestamp prefers AcquisitionDateTime, then acquisition date + AcquisitionTime, then AcquisitionDate (NaT if none are present).
+    
+    Arguments:
+        df - pandas dataframe with a column per VIEW_COLUMNS entry
+         
+    Returns: df, with Timestamp and Created columns added
+    """
 
+    # Combine date of acquisition timestamp with AcquisitionTime, skipping missing, malformed or out-of-range (non HH:MM[:SS[.ffffff]]) times
+    times = df['file.info.AcquisitionTime'].astype('string')
+    times = times.where(times.str.fullmatch(r'([01]\d|2[0-3]):[0-5]\d(:[0-5]\d(\.\d+)?)?').fillna(False))
+    times = times.where(times.str.len() > 5, times + ':00')
+    combined = to_naive_utc(df['acquisition.timestamp']).dt.normalize() + pd.to_timedelta(times, errors='coerce')
 
-def get_all_metadata_for(project):
+    df['Timestamp'] = to_naive_utc(df['file.info.AcquisitionDateTime']) \
+                        .fillna(combined) \
+                        .fillna(to_naive_utc(df['file.info.AcquisitionDate']))
+    df['Created'] = to_naive_utc(df['file.created'])
+
+    return df
+
+
+def get_view_metadata_for(project, date=None):
     """ 
-    Query Flywheel to create a dictionary of all nifti files available in project.
+    Read a Flywheel data view restricted to the metadata fields needed for nifti files in project.
     
     Arguments:
         project - Flywheel project object
-        
-    Returns: info dict, where:
-        info[fileId] = [subId, sesId, acqLabel, filename, seriesNum, timestamp, created]
+        date    - datetime.date object -- if supplied, only files created on or after date are included
+         
+    Returns: pandas dataframe with one row per nifti file and a column per VIEW_COLUMNS and ROW_COLUMNS entry
     """
 
-    # Create info dict with entries for each nifti.
-    info = {}
+    # Get client
+    fw = flywheel.Client()
+
+    # Only return nifti files (created on or after date, if given)
+    viewFilter = 'file.type=nifti'
+    if date:
+        viewFilter += f',file.created>={date}'
+
+    # Build data view over project's acquisition files, without opening file contents
+    view = fw.View(columns=VIEW_COLUMNS, container='acquisition', filename='*', match='all',
+                   process_files=False, include_ids=False, include_labels=False, filter=viewFilter)
+
+    # Read all columns but SeriesNumber as strings, so numeric-looking ids and labels (e.g. '085467') are kept as-is, and leave timestamps unparsed
+    dtypes = {col: 'string' for col in VIEW_COLUMNS if col != 'file.info.SeriesNumber'}
+    df = fw.read_view_dataframe(view, project.id, opts={'dtype': dtypes, 'convert_dates': False})
+
+    # Flywheel returns no response at all when no files matched
+    if df is None:
+        df = pd.DataFrame()
+
+    # Columns other than file info fields are required (unless no files matched at all)
+    missing = [col for col in VIEW_COLUMNS if col not in df and not col.startswith('file.info.')]
+    assert df.empty or not missing, f"Flywheel data view for {project.label} is missing columns {missing}! Exiting."
+
+    # File info fields absent from every file in project are left out of the response, so add them back as empty columns
+    df = df.reindex(columns=VIEW_COLUMNS).astype(dtypes)
+
+    # Keep series numbers as integers even though some files lack them
+    df['file.info.SeriesNumber'] = pd.to_numeric(df['file.info.SeriesNumber'], errors='coerce').astype('Int64')
+
+    return normalize_timestamps(df)
+
+
+def iter_metadata_rows(df):
+    """ 
+    Yield metadata rows for the nifti files in a data view dataframe.
     
-    # Loop through subjects in project
-    for sub in tqdm(project.subjects(), desc=f"Subjects processed", unit="subject", position=0):
+    Arguments:
+        df - pandas dataframe returned by get_view_metadata_for
+         
+    Yields: row = [fileId, subId, sesId, acqLabel, filename, seriesNum, timestamp, created]
+    """
 
-        count=0
-        for ses in sub.sessions():
-            for acq in ses.acquisitions():
-                count+=1
+    yield from df[ROW_COLUMNS].itertuples(index=False, name=None)
+
+
+def get_all_metadata_for(project):
+    """ 
+    Query Flywheel for metadata on all nifti files available in project.
+    
+    Arguments:
+        project - Flywheel project object
         
-        # Set up internal loop progress bar for sessions/acquisitions/files
-        with tqdm(total=count, desc=f"subject {sub.label}", unit="file", leave=False) as pbar:
-            
-            # Loop through sessions in subject
-            for ses in sub.sessions():
-                ses = ses.reload()
-
-                # Loop through acquisitions in session
-                for acq in ses.acquisitions():
-                    acq = acq.reload()
-
-                    # Loop through nifti files in acquisition
-                    for f in acq.files:
-                        if f.type == 'nifti':
-   
-                            # Get other metadata fields from file
-                            fileId, seriesNum, timestamp = get_file_data(f, acq)
-                            
-                            # Add the folowing metadata to study info dict: fileID --> [subId, sesId, acqLabel, fileName, seriesNum, timestamp]
-                            info[fileId] = [sub.label, ses.label, acq.label, f.name, seriesNum, timestamp, f.created.replace(tzinfo=None)]
-                            
-                    # Update progress bar upon completion of each acq
-                    pbar.update(1)
-
-    # Return project info dict
-    return info
+    Returns: iterator of rows, where:
+        row = [fileId, subId, sesId, acqLabel, filename, seriesNum, timestamp, created]
+    """
+
+    df = get_view_metadata_for(project)
+    assert not df.empty, f"No nifti files were found in {project.label}! Exiting."
+
+    return iter_metadata_rows(df)
 
 
 def get_recent_metadata_for(project, date):
     """ 
-    Query Flywheel to create a dictionary of nifti files created/updated on or after given date in project.
+    Query Flywheel for metadata on nifti files created/updated on or after given date in project.
     
     Arguments:
         project - Flywheel project object
         date    - datetime.date object
          
-    Returns: info dict, where:
-        info[fileId] = [subId, sesId, acqLabel, filename, seriesNum, timestamp, created]
+    Returns: iterator of rows, where:
+        row = [fileId, subId, sesId, acqLabel, filename, seriesNum, timestamp, created]
     """
 
-    # Get client
-    fw = flywheel.Client()
+    df = get_view_metadata_for(project, date)
+    assert not df.empty, f"No nifti files created on or after {date} were found in {project.label}! Exiting."
 
-    # Query Flywheel for acquisitions from project containing nifti's created on or after min_date
-    query = f'project.label == {project.label} AND ' \
-                    f'file.type == nifti AND ' \
-                    f'file.created >= {date}'
-
-    results = fw.search({'structured_query': query, 'return_type': 'acquisition'}, size=10000)
-    assert results, f"No nifti files created on or after {date} were found in {project.label}! Exiting."
-
-    # Create info dict with entries for each nifti.
-    info = {}
-
-    # Loop through each result, get subid and sesid related to acquisition, and extract metadata from relevant files.
-    for res in tqdm(results, desc=f"Acquisitions processed", unit="acquisitions", position=0):
-
-        # Get subject and session label
-        subid = res.subject.code
-        sesid = res.session.label
-
-        # Get acquisition object
-        acqid = res.acquisition.id
-        acq = fw.get_acquisition(acqid)
-        acq.reload()
-
-        # Loop through relevant files in acquisition
-        for f in acq.files:
-            if f.type=='nifti' and f.created >= datetime(date.year, date.month, date.day, tzinfo=pytz.UTC):
-                
-                # Get other metadata fields from file
-                fileId, seriesNum, timestamp = get_file_data(f, acq)
-               
-                # Add the folowing metadata to study info dict: fileID --> [subId, sesId, acqLabel, fileName, seriesNum, timestamp]
-                info[fileId] = [subid, sesid, acq.label, f.name, seriesNum, timestamp, f.created.replace(tzinfo=None)]
+    return iter_metadata_rows(df)
+
+
+def write_csv(path, rows):
+    """ 
+    Stream nifti metadata rows to csv file, leaving missing values blank.
     
-    # Return project info dict
-    return info
+    Arguments:
+        path - path to output csv file
+        rows - iterable of rows, where:
+            row = [fileId, subId, sesId, acqLabel, filename, seriesNum, timestamp, created]
+    """
+
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['FlywheelFileId','SubjectId', 'SessionId', 'AcqLabel', 'Filename', 'SeriesNumber','Timestamp', 'Created'])
+        for row in rows:
+            writer.writerow(['' if pd.isnull(value) else value for value in row])
 
 
 def main():
@@ -184,38 +202,32 @@ def main():
     
     ###############################################################################
 
+    # Timestamps are parsed with pd.to_datetime(format='ISO8601'), added in pandas 2.0
+    assert int(pd.__version__.split('.')[0]) >= 2, f"pandas 2.0 or newer is required, found {pd.__version__}! Exiting."
+
     # Use FW client to get project object
     project = get_project(args.project)
 
-    # If date argument was supplied, query Flywheel project for scans created/updated on or after date
-    if args.date:
+    # Set up output csv path
+    min_date = datetime.fromisoformat(args.date).date() if args.date else None
+    filename = f"FlywheelDump_{project.label}_{min_date if min_date else 'all_scans'}_to_{date.today()}.csv"
+    fullpath = os.path.join(args.output, filename)
+    if args.output:
+            os.makedirs(args.output, exist_ok = True)
 
-        # Try to cast date argument to datetime.date type
-        min_date = datetime.fromisoformat(args.date).date()
+    # If date argument was supplied, query Flywheel project for scans created/updated on or after date
+    if min_date:
 
-        # Build info dict containing metadata on all scans in FW project
+        # Stream metadata on recent scans in FW project straight to csv
         print(f"Gathering metadata from Flywheel project '{project.label}' for scans created on or after '{min_date}'...")
-        info = get_recent_metadata_for(project, min_date)      
+        write_csv(fullpath, get_recent_metadata_for(project, min_date))
     
     # Else query for all scans in Flywheel project.
     else:
-        
-        min_date = None
 
-        # Build info dict containing metadata on all scans in FW project
+        # Stream metadata on all scans in FW project straight to csv
         print(f"Gathering all scan metadata from Flywheel project '{project.label}'...")
-        info = get_all_metadata_for(project)
-
-    # Convert info dict to pandas dataframe and rename columns
-    df = pd.DataFrame.from_dict(info, orient='index').reset_index()
-    df.columns=['FlywheelFileId','SubjectId', 'SessionId', 'AcqLabel', 'Filename', 'SeriesNumber','Timestamp', 'Created']
-    
-    # Export dataframe to csv
-    filename = f"FlywheelDump_{project.label}_{min_date if min_date else 'all_scans'}_to_{date.today()}.csv"
-    fullpath = os.path.join(args.output, filename)
-    if args.output:
-            os.makedirs(args.output, exist_ok = True)
-    df.to_csv(fullpath, index=False)
+        write_csv(fullpath, get_all_metadata_for(project))
 
 if __name__== "__main__":
     main()